@@ -0,0 +1,168 @@
+"""
+A compact binary container for calibration results.
+
+The file starts with the 8 byte magic string "CALIBTB\\0", a little-endian
+32-bit format version and a little-endian 32-bit header length. A UTF-8 JSON
+header of that length follows, describing scalar metadata and the dtype,
+shape and byte offset of each array. Array data follows the header, starting
+at the next multiple of 64 bytes. Offsets are relative to the start of the
+array data. Arrays are stored uncompressed in little-endian order with each
+array aligned to 64 bytes so that they may be used directly from a
+memory-mapped file.
+
+Stored arrays are:
+
+    camMatrix       3x3 float64 camera matrix.
+    distCoeffs      float64 vector of distortion coefficients.
+    frameSize       int64 width and height of the frame.
+    usedFrames      int64 frame index of each view.
+    imagePts        NxKx2 float32 corner locations for N views of K corners.
+    rvecs, tvecs    Nx3 float64 rotation and translation vectors.
+    viewErrors      float64 RMS re-projection error of each view.
+    cornerErrors    NxK float64 re-projection error of each corner.
+    errorHeatmap    float64 grid of mean re-projection errors over the frame.
+
+Arrays for which a calibration has no data are omitted.
+
+"""
+import json
+import logging
+import mmap
+import struct
+
+import numpy as np
+
+from calibtools.calib import CalibrationResult, load_calibration, save_calibration
+
+log = logging.getLogger(__name__)
+
+BINARY_MAGIC = b'CALIBTB\0'
+BINARY_VERSION = 1
+BINARY_EXTENSION = '.ctb'
+
+_PREAMBLE = struct.Struct('<8sII')
+_ALIGNMENT = 64
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+def is_binary(filename):
+    """Return True if *filename* is a calibration in binary format."""
+    with open(filename, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+def save_binary(filename, result, video=None):
+    """Write the :py:class:`calibtools.calib.CalibrationResult` *result* to
+    *filename* in binary format. *video* records the input video and defaults
+    to the result's video.
+
+    """
+    arrays = [
+        ('camMatrix', result.cam_matrix, '<f8'),
+        ('distCoeffs', result.dist_coeffs, '<f8'),
+        ('frameSize', result.frame_size, '<i8'),
+    ]
+
+    if result.used_frames is not None:
+        arrays.append(('usedFrames', result.used_frames, '<i8'))
+    if result.image_pts is not None and len(result.image_pts) > 0:
+        arrays.append(('imagePts', np.asarray(result.image_pts).reshape(len(result.image_pts), -1, 2), '<f4'))
+    if result.rvecs is not None:
+        arrays.append(('rvecs', np.asarray(result.rvecs).reshape(-1, 3), '<f8'))
+    if result.tvecs is not None:
+        arrays.append(('tvecs', np.asarray(result.tvecs).reshape(-1, 3), '<f8'))
+    if result.view_errors is not None:
+        arrays.append(('viewErrors', result.view_errors, '<f8'))
+    if result.corner_errors is not None:
+        arrays.append(('cornerErrors', result.corner_errors, '<f8'))
+    if result.error_heatmap is not None:
+        arrays.append(('errorHeatmap', result.error_heatmap, '<f8'))
+
+    arrays = list((name, np.ascontiguousarray(a, dtype=dtype)) for name, a, dtype in arrays)
+
+    # Lay out arrays one after another in the data section
+    header = {
+        'meta': {
+            'reprojError': result.reproj_error,
+            'checkerboardShape': result.cb_shape,
+            'video': video if video is not None else result.video,
+        },
+        'arrays': {},
+    }
+    offset = 0
+    for name, a in arrays:
+        header['arrays'][name] = { 'dtype': a.dtype.str, 'shape': a.shape, 'offset': offset }
+        offset = _align(offset + a.nbytes)
+
+    header_bytes = json.dumps(header).encode('utf8')
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+
+    with open(filename, 'wb') as f:
+        f.write(_PREAMBLE.pack(BINARY_MAGIC, BINARY_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, a in arrays:
+            f.write(b'\0' * (data_start + header['arrays'][name]['offset'] - f.tell()))
+            f.write(a.tobytes())
+
+def load_binary(filename):
+    """Load a :py:class:`calibtools.calib.CalibrationResult` from the binary
+    format file *filename*. The file is memory-mapped and arrays in the
+    result are read-only views on to it.
+
+    """
+    with open(filename, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, header_len = _PREAMBLE.unpack_from(buf)
+    if magic != BINARY_MAGIC:
+        raise ValueError('{0} is not a binary calibration file'.format(filename))
+    if version > BINARY_VERSION:
+        raise ValueError('Unsupported binary calibration version {0} in {1}'.format(
+            version, filename))
+
+    header = json.loads(buf[_PREAMBLE.size:_PREAMBLE.size + header_len].decode('utf8'))
+    meta = header['meta']
+    data_start = _align(_PREAMBLE.size + header_len)
+
+    arrays = {}
+    for name, desc in header['arrays'].items():
+        dtype = np.dtype(desc['dtype'])
+        shape = tuple(desc['shape'])
+        count = 1
+        for dim in shape:
+            count *= dim
+        if count == 0:
+            # Empty arrays may lie beyond the end of the file
+            arrays[name] = np.zeros(shape, dtype=dtype)
+            continue
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=count,
+                offset=data_start + desc['offset']).reshape(shape)
+
+    image_pts = arrays.get('imagePts')
+    if image_pts is not None:
+        image_pts = image_pts.reshape(image_pts.shape[0], -1, 1, 2)
+
+    used_frames = arrays.get('usedFrames')
+    return CalibrationResult(arrays['camMatrix'], arrays['distCoeffs'],
+            arrays['frameSize'], reproj_error=meta.get('reprojError'),
+            cb_shape=meta.get('checkerboardShape'),
+            used_frames=used_frames.tolist() if used_frames is not None else None,
+            image_pts=image_pts, rvecs=arrays.get('rvecs'),
+            tvecs=arrays.get('tvecs'), view_errors=arrays.get('viewErrors'),
+            corner_errors=arrays.get('cornerErrors'),
+            error_heatmap=arrays.get('errorHeatmap'), video=meta.get('video'))
+
+def tool(input, output):
+    log.info('Loading calibration from {0}...'.format(input))
+    try:
+        result = load_calibration(input)
+    except (IOError, KeyError, ValueError) as e:
+        log.error('Could not load calibration {0}: {1}'.format(input, e))
+        return 1
+
+    if not output.endswith(BINARY_EXTENSION) and result.image_pts is not None:
+        log.warning('Per-view corners and poses are not stored in JSON format and will be discarded')
+
+    save_calibration(output if output != '-' else None, result)
+
+    return 0
@@ -6,7 +6,8 @@ import sys
 import cv2
 import numpy as np
 
-from calibtools.util import open_video
+from calibtools.residuals import analyse_residuals
+from calibtools.util import open_video, read_frames
 
 log = logging.getLogger(__name__)
 
@@ -62,85 +63,321 @@ def corner_shape_parameters(corners, frame_shape, cb_shape):
 
     return (X, Y, size, skew)
 
-def tool(video, cb_shape, autostop=True, skip=None, output=None, start=None,
-        duration=None, threshold=None):
-    # Load input video
-    vc = open_video(video)
+# Amount by which a pre-screened board must fall below the selection threshold
+# before we reject it without a full resolution detection. This allows for the
+# error in parameters estimated from the downscaled frame.
+PRESCREEN_MARGIN = 0.05
 
-    # Parse chessboard shape
-    if len(cb_shape) != 2:
-        log.error('Chessboard shape should have 2 components, a width and height.')
-        return 1
-    log.debug('Using chessboard with shape: {0}x{1}'.format(*cb_shape))
+def min_board_delta(board_params, used_board_params):
+    """Return the minimum L1 distance between the board parameters
+    *board_params* and each of the parameters in *used_board_params*.
 
-    # Defaults
-    skip = skip or 1
-    start = start or 0
-    log.debug('Processing every {0} frame(s) from {1}'.format(skip, start))
+    """
+    used_board_params = np.asarray(used_board_params).reshape(-1, len(board_params))
+    return np.abs(used_board_params - board_params).sum(axis=1).min()
+
+def prescreen_board(frame, cb_shape, scale):
+    """Perform a cheap detection of a chessboard in the greyscale image
+    *frame* after downscaling it by *scale*. Return an Nx2 array of
+    approximate corner locations in full resolution co-ordinates or None if
+    no board was found.
+
+    """
+    small = cv2.resize(frame, None, fx=scale, fy=scale,
+            interpolation=cv2.INTER_AREA)
+    rv, corners = cv2.findChessboardCorners(small,
+            cb_shape, flags=cv2.CALIB_CB_FAST_CHECK)
+    if not rv:
+        return None
+    return corners.reshape(-1, 2) / scale
+
+class CalibrationProgress(object):
+    """Progress report for a board accepted by a :py:class:`Calibrator`.
+
+    *frame_idx* is the index of the frame containing the board, *board_params*
+    are the board's shape parameters as returned by
+    :py:func:`corner_shape_parameters` and *progress* is an array giving the
+    progress on the interval [0,1] towards full coverage for each parameter.
+
+    """
+    def __init__(self, frame_idx, board_params, progress):
+        self.frame_idx = frame_idx
+        self.board_params = board_params
+        self.progress = progress
+
+    def __str__(self):
+        return ' '.join(
+                '{1}:{0}%'.format(int(100*x), k)
+                for x, k in zip(self.progress, Calibrator.param_labels)
+        )
+
+class CalibrationResult(object):
+    """The result of calibrating a camera.
+
+    *cam_matrix* is the 3x3 camera matrix, *dist_coeffs* is a vector of
+    distortion coefficients in OpenCV's order and *frame_size* is a pair
+    giving the width and height of the frame. *reproj_error* is the RMS
+    re-projection error in pixels.
+
+    The remaining arguments record the views used for calibration and may be
+    None if they are not known. *cb_shape* is the checkerboard shape,
+    *used_frames* is a sequence of frame indices, *image_pts* is a sequence of
+    Nx1x2 arrays of corner locations and *rvecs* and *tvecs* are the
+    sequences of per-view rotation and translation vectors. *view_errors* is
+    a sequence of per-view RMS re-projection errors in pixels, *corner_errors*
+    is an array of per-corner re-projection errors for each view and
+    *error_heatmap* is a grid of mean re-projection errors over the frame as
+    returned by :py:func:`calibtools.residuals.error_heatmap`. *video*
+    records the input video.
+
+    """
+    def __init__(self, cam_matrix, dist_coeffs, frame_size, reproj_error=None,
+            cb_shape=None, used_frames=None, image_pts=None, rvecs=None,
+            tvecs=None, view_errors=None, corner_errors=None,
+            error_heatmap=None, video=None):
+        self.cam_matrix = np.asarray(cam_matrix, dtype=np.float64).reshape(3, 3)
+        self.dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64).reshape(-1)
+        self.frame_size = tuple(int(x) for x in frame_size)
+        self.reproj_error = reproj_error
+        self.cb_shape = tuple(cb_shape) if cb_shape is not None else None
+        self.used_frames = list(used_frames) if used_frames is not None else None
+        self.image_pts = image_pts
+        self.rvecs = rvecs
+        self.tvecs = tvecs
+        self.view_errors = view_errors
+        self.corner_errors = corner_errors
+        self.error_heatmap = error_heatmap
+        self.video = video
+
+    def to_dict(self):
+        """Return the calibration as a dictionary suitable for the "output"
+        section of the JSON calibration format.
+
+        """
+        output = {
+            'frameSize': list(self.frame_size),
+            'reprojError': self.reproj_error,
+            'camMatrix': self.cam_matrix.tolist(),
+            'distCoeffs': self.dist_coeffs.tolist(),
+        }
+
+        if self.view_errors is not None:
+            output['viewErrors'] = np.asarray(self.view_errors).tolist()
+        if self.corner_errors is not None:
+            output['cornerErrors'] = np.asarray(self.corner_errors).tolist()
+        if self.error_heatmap is not None:
+            # Empty cells are NaN which JSON cannot represent
+            output['errorHeatmap'] = list(
+                    list(None if np.isnan(x) else x for x in row)
+                    for row in np.asarray(self.error_heatmap).tolist()
+            )
+
+        return output
+
+    @classmethod
+    def from_dict(cls, calibration):
+        """Construct a result from a dictionary in the JSON calibration
+        format. Files written by older versions of calibtools are also
+        accepted.
+
+        """
+        output = calibration['output']
+        input_ = calibration.get('input')
+        if not isinstance(input_, dict):
+            # Older files record only the input video
+            input_ = { 'video': input_ }
+
+        error_heatmap = output.get('errorHeatmap')
+        if error_heatmap is not None:
+            error_heatmap = np.asarray(error_heatmap, dtype=np.float64)
+
+        corner_errors = output.get('cornerErrors')
+        if corner_errors is not None:
+            corner_errors = np.asarray(corner_errors, dtype=np.float64)
+
+        return cls(output['camMatrix'], output['distCoeffs'],
+                output['frameSize'], reproj_error=output.get('reprojError'),
+                cb_shape=input_.get('checkerboard_shape'),
+                used_frames=input_.get('used_frames'),
+                view_errors=output.get('viewErrors'),
+                corner_errors=corner_errors, error_heatmap=error_heatmap,
+                video=input_.get('video'))
+
+def load_calibration(filename):
+    """Load a :py:class:`CalibrationResult` from *filename*, which may be in
+    either JSON or binary format.
+
+    """
+    from calibtools.binary import is_binary, load_binary
+    if is_binary(filename):
+        return load_binary(filename)
 
-    image_pts = []
-    frame_shape = None
-    used_frames = []
+    with open(filename) as f:
+        return CalibrationResult.from_dict(json.load(f))
 
-    # A list of parameters for each board we used
-    used_board_params = []
-    minmax_parameters = None
+def save_calibration(filename, result, video=None):
+    """Write the :py:class:`CalibrationResult` *result* to *filename*. If
+    *filename* has the binary format's extension, the binary format is used.
+    Otherwise JSON format is used. *video* records the input video and
+    defaults to the result's video. If *filename* is None, write JSON to
+    standard output.
+
+    """
+    video = video if video is not None else result.video
+
+    from calibtools.binary import BINARY_EXTENSION, save_binary
+    if filename is not None and filename.endswith(BINARY_EXTENSION):
+        log.debug('Writing binary result to {0}.'.format(filename))
+        save_binary(filename, result, video=video)
+        return
+
+    calib_result = {
+        'input': {
+            'video': video,
+            'checkerboard_shape': result.cb_shape,
+            'used_frames': result.used_frames,
+        },
+        'output': result.to_dict(),
+    }
+
+    if filename is not None:
+        log.debug('Writing result to {0}.'.format(filename))
+    json.dump(calib_result, open(filename, 'w') if filename is not None else sys.stdout, indent=2)
+
+class Calibrator(object):
+    """Select views of a checkerboard from a sequence of frames and use them
+    to calibrate a camera.
+
+    *cb_shape* is a pair giving the number of horizontal and vertical corners.
+    Boards whose shape parameters are not different by at least *threshold*
+    from those already seen are ignored. If *prescreen* is a scale on the
+    interval (0,1), redundant boards are rejected early via a detection on a
+    downscaled frame. A *prescreen* of 1 or None disables pre-screening. If
+    *autostop* is True, :py:attr:`done` is set once enough variation in board
+    shape has been observed.
+
+    """
     goals = np.asarray((0.7, 0.7, 0.4, 0.5))
     param_labels = ('X', 'Y', 'size', 'skew')
 
-    for frame_idx in itertools.count(0):
-        flag, frame = vc.read()
-        if not flag:
-            break
+    def __init__(self, cb_shape, threshold=None, prescreen=None, autostop=True):
+        if len(cb_shape) != 2:
+            raise ValueError('Chessboard shape should have 2 components, a width and height.')
+        if prescreen is not None and not 0 < prescreen <= 1:
+            raise ValueError('Pre-screen scale should be greater than 0 and at most 1.')
 
-        # Skip frame if we're not processing this one
-        if frame_idx < start or frame_idx % skip != 0:
-            continue
+        self.cb_shape = tuple(cb_shape)
+        self.threshold = threshold
+        self.prescreen = prescreen
+        self.autostop = autostop
 
-        # Stop processing after specified duration
-        if duration is not None and frame_idx >= start + duration:
-            break
+        self.frame_shape = None
+        self.frame_count = 0
+        self.done = False
+
+        self.image_pts = []
+        self.used_frames = []
+
+        # A list of parameters for each board we used
+        self.used_board_params = []
+        self.minmax_parameters = None
+
+    def add_frame(self, frame, frame_idx=None):
+        """Process a single frame. *frame* is either a greyscale image or an
+        RGB image. *frame_idx* is the index recorded for the frame and
+        defaults to the number of frames processed so far.
+
+        Return a :py:class:`CalibrationProgress` if the frame contained a
+        board which was used or None otherwise.
+
+        """
+        if frame_idx is None:
+            frame_idx = self.frame_count
+        self.frame_count += 1
 
         log.debug('Processing frame {0}'.format(frame_idx))
 
         # Convert to grayscale
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-        if frame_shape is None:
-            frame_shape = frame.shape
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        if self.frame_shape is None:
+            self.frame_shape = frame.shape
+
+        cb_shape, threshold = self.cb_shape, self.threshold
+        used_board_params = self.used_board_params
+
+        # If we already have some boards, see if a quick detection on a
+        # downscaled frame shows that this one is obviously redundant. If the
+        # quick detection fails we fall back to a full detection below.
+        if self.prescreen is not None and self.prescreen < 1 and \
+                len(used_board_params) > 0 and threshold is not None:
+            approx_corners = prescreen_board(frame, cb_shape, self.prescreen)
+            if approx_corners is not None:
+                approx_params = np.asarray(corner_shape_parameters(
+                    approx_corners, self.frame_shape, cb_shape))
+                approx_delta = min_board_delta(approx_params, used_board_params)
+                log.debug('Pre-screened board has minimum L1 delta {0}'.format(approx_delta))
+                if approx_delta < threshold - PRESCREEN_MARGIN:
+                    return None
 
         # Look for chessboard
         rv, corners = cv2.findChessboardCorners(frame,
                 cb_shape, flags=cv2.CALIB_CB_FAST_CHECK)
         if not rv:
-            continue
+            return None
 
         log.debug('Board found in frame {0}'.format(frame_idx))
 
-        board_params = np.asarray(corner_shape_parameters(corners, frame_shape, cb_shape))
+        board_params = np.asarray(corner_shape_parameters(corners, self.frame_shape, cb_shape))
         log.debug('Board has parameters: {0}'.format(board_params))
 
+        if not self.is_novel(board_params):
+            return None
+
+        # Refine corners
+        cv2.cornerSubPix(frame, corners, (5,5), (-1,-1),
+                (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 100, 0.03))
+
+        return self.add_board(corners, board_params, frame_idx)
+
+    def is_novel(self, board_params):
+        """Return True if a board with shape parameters *board_params* is
+        sufficiently different from those already used to be worth using.
+
+        """
+        threshold, used_board_params = self.threshold, self.used_board_params
+
         log.debug('Automatic selection threshold is {0}'.format(threshold))
 
         # If we have previous parameters and we auto threshold, see if we go
         # any further
         if len(used_board_params) > 0 and threshold is not None:
             # Compute L1 distance in parameters for each prior board
-            min_l1_delta = np.asarray(
-                    list(np.sum(np.abs(p - board_params)) for p in used_board_params)
-            ).min()
+            min_l1_delta = min_board_delta(board_params, used_board_params)
 
             log.debug('Minimum L1 delta is {0}'.format(min_l1_delta))
 
             # Is minimum distance not good?
             if min_l1_delta < threshold:
-                continue
+                return False
+
+        return True
+
+    def add_board(self, corners, board_params, frame_idx):
+        """Use the refined board corners *corners* with shape parameters
+        *board_params* found in frame *frame_idx* for calibration. No
+        selection is performed. Return a :py:class:`CalibrationProgress`.
+
+        """
+        board_params = np.asarray(board_params)
 
         # Add this board's parameters to our records
-        used_board_params.append(board_params)
+        self.used_board_params.append(board_params)
 
         # Update minimum and maximum params
+        minmax_parameters = self.minmax_parameters
         if minmax_parameters is None:
-            minmax_parameters = np.vstack((board_params, board_params))
+            minmax_parameters = self.minmax_parameters = np.vstack((board_params, board_params))
         else:
             minmax_parameters[0,:] = np.minimum(minmax_parameters[0,:], board_params)
             minmax_parameters[1,:] = np.maximum(minmax_parameters[1,:], board_params)
@@ -148,61 +385,138 @@ def tool(video, cb_shape, autostop=True, skip=None, output=None, start=None,
         # Compute progress towards full coverage
         ranges = minmax_parameters[1,:] - minmax_parameters[0,:]
         ranges[2:] = minmax_parameters[1,2:] # Don't reward small sizes or small skews
-        progress = np.clip(ranges / goals, 0, 1)
-        progress_str = ' '.join(
-                '{1}:{0}%'.format(int(100*x), k) for x, k in zip(progress, param_labels)
-        )
+        progress = np.clip(ranges / self.goals, 0, 1)
 
-        log.info('Using board in frame {0}. Progress: {1}'.format(frame_idx, progress_str))
         log.debug('Parameter ranges: {0}'.format(minmax_parameters.T.tolist()))
 
-        # Refine corners
-        cv2.cornerSubPix(frame, corners, (5,5), (-1,-1),
-                (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 100, 0.03))
-
         # Record corners
-        image_pts.append(corners)
-        used_frames.append(frame_idx)
+        self.image_pts.append(np.asarray(corners, dtype=np.float32).reshape(-1, 1, 2))
+        self.used_frames.append(frame_idx)
 
         # Do we auto-stop?
-        if autostop and np.all(progress > 0.99):
-            break
+        if self.autostop and np.all(progress > 0.99):
+            self.done = True
+
+        return CalibrationProgress(frame_idx, board_params, progress)
+
+    def scan(self, frames):
+        """Process each frame from the iterable *frames* in turn, yielding a
+        :py:class:`CalibrationProgress` for each board which is used. Stops
+        early if :py:attr:`done` becomes True.
+
+        """
+        for frame in frames:
+            if self.done:
+                break
+            progress = self.add_frame(frame)
+            if progress is not None:
+                yield progress
+
+    def calibrate(self, outlier_factor=None):
+        """Calibrate the camera from the boards used so far and return a
+        :py:class:`CalibrationResult`. Raises ValueError if no boards have
+        been found.
+
+        If *outlier_factor* is not None, views whose RMS re-projection error
+        exceeds *outlier_factor* times the median view error are dropped and
+        the camera is calibrated again without them. The factor must be at
+        least 1 so that at least half of the views are kept. Dropped views
+        are only left out of the returned result; the boards used by the
+        calibrator are unchanged.
+
+        """
+        if len(self.image_pts) == 0:
+            raise ValueError('No chessboards found')
+        if outlier_factor is not None and not outlier_factor >= 1:
+            raise ValueError('Outlier factor must be at least 1')
+
+        image_pts, used_frames = list(self.image_pts), list(self.used_frames)
+        result = self._solve(image_pts, used_frames)
+
+        if outlier_factor is not None:
+            threshold = outlier_factor * np.median(result.view_errors)
+            keep = list(result.view_errors <= threshold)
+            if not all(keep):
+                log.info('Dropping {0} outlier view(s) from frame(s) {1}'.format(
+                    keep.count(False),
+                    list(f for f, k in zip(used_frames, keep) if not k)))
+
+                image_pts = list(x for x, k in zip(image_pts, keep) if k)
+                used_frames = list(x for x, k in zip(used_frames, keep) if k)
+
+                # Start from the previous solution to speed convergence
+                result = self._solve(image_pts, used_frames, result)
+
+        return result
+
+    def _solve(self, image_pts, used_frames, initial=None):
+        cb_shape, frame_shape = self.cb_shape, self.frame_shape
+
+        # Generate chessboard object points
+        cb_coords = np.zeros((cb_shape[0] * cb_shape[1], 3), dtype=np.float32)
+        cb_coords[:,:2] = np.asarray(list(itertools.product(range(cb_shape[1]), range(cb_shape[0]))))
+        cb_pts = [ cb_coords ] * len(image_pts)
+
+        flags = cv2.CALIB_RATIONAL_MODEL
+        if initial is not None:
+            cam_matrix = initial.cam_matrix.copy()
+            dist_coeffs = initial.dist_coeffs.copy()
+            flags |= cv2.CALIB_USE_INTRINSIC_GUESS
+        else:
+            cam_matrix = np.eye(3)
+            dist_coeffs = None
 
-    if len(image_pts) == 0:
-        log.error('No chessboards found in video')
-        return 1
+        # Calibrate
+        log.info('Calibrating with {0} frame(s)...'.format(len(image_pts)))
+        reproj_err, cam_matrix, dist_coeffs, rvecs, tvecs = cv2.calibrateCamera(
+                cb_pts, image_pts, frame_shape[::-1], cam_matrix, dist_coeffs,
+                flags=flags,
+                criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
 
-    # Generate chessboard object points
-    cb_coords = np.zeros((cb_shape[0] * cb_shape[1], 3), dtype=np.float32)
-    cb_coords[:,:2] = np.asarray(list(itertools.product(range(cb_shape[1]), range(cb_shape[0]))))
-    cb_pts = [ cb_coords ] * len(image_pts)
+        log.info('Re-projection error is {0} pixels'.format(reproj_err))
 
-    # Calibrate
-    log.info('Calibrating with {0} frame(s)...'.format(len(image_pts)))
-    cam_matrix = np.eye(3)
-    reproj_err, cam_matrix, dist_coeffs, rvecs, tvecs = cv2.calibrateCamera(
-            cb_pts, image_pts, frame_shape[::-1], cam_matrix, None,
-            flags=cv2.CALIB_RATIONAL_MODEL,
-            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        view_errors, corner_errors, heatmap = analyse_residuals(cb_coords,
+                image_pts, rvecs, tvecs, cam_matrix, dist_coeffs,
+                frame_shape[::-1])
+        log.debug('Per-view re-projection errors: {0}'.format(view_errors.tolist()))
 
-    log.info('Re-projection error is {0} pixels'.format(reproj_err))
+        return CalibrationResult(cam_matrix, dist_coeffs, frame_shape[::-1],
+                reproj_error=reproj_err, cb_shape=cb_shape,
+                used_frames=used_frames, image_pts=list(image_pts),
+                rvecs=list(rvecs), tvecs=list(tvecs), view_errors=view_errors,
+                corner_errors=corner_errors, error_heatmap=heatmap)
 
-    calib_result = {
-        'input': {
-            'video': video,
-            'checkerboard_shape': cb_shape,
-            'used_frames': used_frames,
-        },
-        'output': {
-            'frameSize': frame_shape[::-1],
-            'reprojError': reproj_err,
-            'camMatrix': cam_matrix.tolist(),
-            'distCoeffs': dist_coeffs.reshape(-1).tolist(),
-        },
-    }
+def tool(video, cb_shape, autostop=True, skip=None, output=None, start=None,
+        duration=None, threshold=None, prescreen=None, outlier_factor=None):
+    # Load input video
+    vc = open_video(video)
+
+    # Parse chessboard shape
+    try:
+        calibrator = Calibrator(cb_shape, threshold=threshold,
+                prescreen=prescreen, autostop=autostop)
+    except ValueError as e:
+        log.error(str(e))
+        return 1
+    log.debug('Using chessboard with shape: {0}x{1}'.format(*cb_shape))
+
+    # Defaults
+    skip = skip or 1
+    start = start or 0
+    log.debug('Processing every {0} frame(s) from {1}'.format(skip, start))
+
+    for frame_idx, frame in read_frames(vc, start=start, duration=duration, skip=skip):
+        progress = calibrator.add_frame(frame, frame_idx)
+        if progress is not None:
+            log.info('Using board in frame {0}. Progress: {1}'.format(frame_idx, progress))
+        if calibrator.done:
+            break
+
+    if len(calibrator.image_pts) == 0:
+        log.error('No chessboards found in video')
+        return 1
 
-    if output is not None:
-        log.debug('Writing result to {0}.'.format(output))
-    json.dump(calib_result, open(output, 'w') if output is not None else sys.stdout, indent=2)
+    result = calibrator.calibrate(outlier_factor=outlier_factor)
+    save_calibration(output, result, video=video)
 
     return 0
@@ -0,0 +1,76 @@
+import logging
+import os
+
+from calibtools.calib import Calibrator, save_calibration
+from calibtools.scan import load_checkpoint
+
+log = logging.getLogger(__name__)
+
+def tool(checkpoints, output=None, threshold=None, outlier_factor=None,
+        force=False):
+    # Load the per-chunk checkpoints
+    states = []
+    for filename in checkpoints:
+        try:
+            state = load_checkpoint(filename)
+        except (IOError, KeyError, ValueError) as e:
+            log.error('Could not load checkpoint {0}: {1}'.format(filename, e))
+            return 1
+        if not state['complete']:
+            log.warning('Scan in checkpoint {0} is incomplete'.format(filename))
+        states.append(state)
+
+    if len(states) == 0:
+        log.error('No checkpoints given')
+        return 1
+
+    cb_shape = states[0]['cb_shape']
+    if any(s['cb_shape'] != cb_shape for s in states):
+        log.error('Checkpoints use different chessboard shapes')
+        return 1
+
+    frame_shapes = set(s['frame_shape'] for s in states if s['frame_shape'] is not None)
+    if len(frame_shapes) > 1:
+        log.error('Checkpoints were scanned from frames of different sizes')
+        return 1
+
+    # The same recording may be mounted at different paths on the machines
+    # which scanned it so only insist on matching file names
+    videos = set(s['video'] for s in states)
+    if len(videos) > 1:
+        msg = 'Checkpoints were scanned from different videos: {0}'.format(
+            ', '.join(sorted(videos)))
+        if not force and len(set(os.path.basename(v) for v in videos)) > 1:
+            log.error(msg)
+            return 1
+        log.warning(msg)
+    video = states[0]['video']
+
+    # Gather boards from all chunks in frame order, dropping any which appear
+    # in more than one chunk
+    boards = {}
+    for state in states:
+        for frame_idx, board_params, corners in zip(state['used_frames'],
+                state['board_params'], state['image_pts']):
+            boards[frame_idx] = (board_params, corners)
+
+    log.info('Loaded {0} board(s) from {1} checkpoint(s)'.format(len(boards), len(states)))
+
+    # Apply board selection over the whole scan
+    calibrator = Calibrator(cb_shape, threshold=threshold, autostop=False)
+    calibrator.frame_shape = frame_shapes.pop() if len(frame_shapes) > 0 else None
+    for frame_idx in sorted(boards.keys()):
+        board_params, corners = boards[frame_idx]
+        if calibrator.is_novel(board_params):
+            calibrator.add_board(corners, board_params, frame_idx)
+
+    if len(calibrator.image_pts) == 0:
+        log.error('No chessboards found in checkpoints')
+        return 1
+
+    log.info('Selected {0} of {1} board(s)'.format(len(calibrator.image_pts), len(boards)))
+
+    result = calibrator.calibrate(outlier_factor=outlier_factor)
+    save_calibration(output, result, video=video)
+
+    return 0
@@ -0,0 +1,142 @@
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+def rodrigues(rvecs):
+    """Convert an Nx3 array of rotation vectors *rvecs* into an Nx3x3 array
+    of rotation matrices. This is a batched equivalent of cv2.Rodrigues.
+
+    """
+    rvecs = np.asarray(rvecs, dtype=np.float64).reshape(-1, 3)
+    theta = np.sqrt(np.sum(rvecs * rvecs, axis=1))
+
+    # Avoid dividing by zero for null rotations. The axis is irrelevant then
+    # since sin(theta) and 1 - cos(theta) are both zero.
+    safe_theta = np.where(theta > 1e-12, theta, 1)
+    k = rvecs / safe_theta[:,np.newaxis]
+    kx, ky, kz = k[:,0], k[:,1], k[:,2]
+    zero = np.zeros_like(kx)
+
+    # Cross product matrix of each axis
+    K = np.stack((
+        np.stack((zero, -kz, ky), axis=1),
+        np.stack((kz, zero, -kx), axis=1),
+        np.stack((-ky, kx, zero), axis=1),
+    ), axis=1)
+
+    s, c = np.sin(theta)[:,np.newaxis,np.newaxis], np.cos(theta)[:,np.newaxis,np.newaxis]
+    return np.eye(3) + s * K + (1 - c) * np.matmul(K, K)
+
+def _tilt_matrix(tau_x, tau_y):
+    # Follows computeTiltProjectionMatrix() in OpenCV
+    c_x, s_x = np.cos(tau_x), np.sin(tau_x)
+    c_y, s_y = np.cos(tau_y), np.sin(tau_y)
+    rot_x = np.asarray([[1, 0, 0], [0, c_x, s_x], [0, -s_x, c_x]])
+    rot_y = np.asarray([[c_y, 0, -s_y], [0, 1, 0], [s_y, 0, c_y]])
+    rot_xy = rot_y.dot(rot_x)
+    proj_z = np.asarray([
+        [rot_xy[2,2], 0, -rot_xy[0,2]],
+        [0, rot_xy[2,2], -rot_xy[1,2]],
+        [0, 0, 1],
+    ])
+    return proj_z.dot(rot_xy)
+
+def project_points(object_pts, rvecs, tvecs, cam_matrix, dist_coeffs):
+    """Project object points into every view at once. This is a batched
+    equivalent of calling cv2.projectPoints for each view and supports the
+    same distortion model.
+
+    *object_pts* is a Kx3 array of points shared by all views or an NxKx3
+    array of per-view points. *rvecs* and *tvecs* give the pose of each of
+    the N views. *cam_matrix* and *dist_coeffs* are the camera intrinsics.
+    Return an NxKx2 array of image points.
+
+    """
+    rvecs = np.asarray(rvecs, dtype=np.float64).reshape(-1, 3)
+    tvecs = np.asarray(tvecs, dtype=np.float64).reshape(-1, 3)
+    object_pts = np.asarray(object_pts, dtype=np.float64)
+    cam_matrix = np.asarray(cam_matrix, dtype=np.float64).reshape(3, 3)
+
+    k = np.zeros(14)
+    dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64).reshape(-1)
+    k[:dist_coeffs.shape[0]] = dist_coeffs
+
+    # Transform into camera co-ordinates
+    R = rodrigues(rvecs)
+    cam_pts = np.matmul(object_pts, R.transpose(0, 2, 1))
+    cam_pts += tvecs[:,np.newaxis,:]
+
+    z = cam_pts[...,2]
+    z = np.where(z != 0, z, 1)
+    x, y = cam_pts[...,0] / z, cam_pts[...,1] / z
+
+    # Apply distortion
+    r2 = x*x + y*y
+    r4 = r2*r2
+    r6 = r4*r2
+    a1, a2, a3 = 2*x*y, r2 + 2*x*x, r2 + 2*y*y
+    radial = (1 + k[0]*r2 + k[1]*r4 + k[4]*r6) / (1 + k[5]*r2 + k[6]*r4 + k[7]*r6)
+    xd = x*radial + k[2]*a1 + k[3]*a2 + k[8]*r2 + k[9]*r4
+    yd = y*radial + k[2]*a3 + k[3]*a1 + k[10]*r2 + k[11]*r4
+
+    # Apply sensor tilt
+    if k[12] != 0 or k[13] != 0:
+        tilt = _tilt_matrix(k[12], k[13])
+        tx = tilt[0,0]*xd + tilt[0,1]*yd + tilt[0,2]
+        ty = tilt[1,0]*xd + tilt[1,1]*yd + tilt[1,2]
+        tz = tilt[2,0]*xd + tilt[2,1]*yd + tilt[2,2]
+        tz = np.where(tz != 0, tz, 1)
+        xd, yd = tx / tz, ty / tz
+
+    u = cam_matrix[0,0]*xd + cam_matrix[0,2]
+    v = cam_matrix[1,1]*yd + cam_matrix[1,2]
+    return np.stack((u, v), axis=-1)
+
+def error_heatmap(image_pts, corner_errors, frame_size, grid_shape=(8, 8)):
+    """Return the mean re-projection error of corners within each cell of a
+    grid over the frame. *image_pts* is an NxKx2 array of observed corner
+    locations and *corner_errors* is the corresponding NxK array of errors.
+    *frame_size* gives the frame's width and height and *grid_shape* gives the
+    number of rows and columns in the grid. Cells without corners are NaN.
+
+    """
+    rows, cols = grid_shape
+    w, h = frame_size
+    image_pts = np.asarray(image_pts).reshape(-1, 2)
+    corner_errors = np.asarray(corner_errors).reshape(-1)
+
+    col_idxs = np.clip((image_pts[:,0] * (cols / w)).astype(np.int64), 0, cols-1)
+    row_idxs = np.clip((image_pts[:,1] * (rows / h)).astype(np.int64), 0, rows-1)
+    cell_idxs = row_idxs * cols + col_idxs
+
+    counts = np.bincount(cell_idxs, minlength=rows*cols)
+    totals = np.bincount(cell_idxs, weights=corner_errors, minlength=rows*cols)
+
+    heatmap = np.full(rows*cols, np.nan)
+    np.divide(totals, counts, out=heatmap, where=counts > 0)
+    return heatmap.reshape(rows, cols)
+
+def analyse_residuals(object_pts, image_pts, rvecs, tvecs, cam_matrix,
+        dist_coeffs, frame_size, grid_shape=(8, 8)):
+    """Compute re-projection errors for all views of a calibration in one
+    batched pass. Arguments are as for :py:func:`project_points` and
+    :py:func:`error_heatmap`.
+
+    Return a tuple of an N-vector of per-view RMS errors, an NxK array of
+    per-corner errors and an error heatmap.
+
+    """
+    image_pts = np.asarray(image_pts, dtype=np.float64)
+    image_pts = image_pts.reshape(image_pts.shape[0], -1, 2)
+
+    projected = project_points(object_pts, rvecs, tvecs, cam_matrix, dist_coeffs)
+    deltas = projected - image_pts
+    sq_errors = np.sum(deltas * deltas, axis=-1)
+
+    corner_errors = np.sqrt(sq_errors)
+    view_errors = np.sqrt(np.mean(sq_errors, axis=1))
+    heatmap = error_heatmap(image_pts, corner_errors, frame_size, grid_shape)
+
+    return view_errors, corner_errors, heatmap
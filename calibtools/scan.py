@@ -0,0 +1,151 @@
+import logging
+import os
+
+import numpy as np
+
+from calibtools.calib import Calibrator
+from calibtools.util import open_video, read_frames
+
+log = logging.getLogger(__name__)
+
+# Version of the checkpoint file layout written by save_checkpoint()
+CHECKPOINT_VERSION = 1
+
+# Maximum number of frames to process between checkpoints when no new boards
+# are found
+CHECKPOINT_INTERVAL = 250
+
+def save_checkpoint(filename, calibrator, scan, next_frame, complete=False):
+    """Write the boards used so far by the :py:class:`Calibrator`
+    *calibrator* to the checkpoint file *filename*. *scan* is a dictionary
+    with keys video, start, duration and skip describing the frame range being
+    scanned. *next_frame* is the index of the next frame to process and
+    *complete* indicates whether the scan has finished.
+
+    The checkpoint is written atomically so that an interrupted scan never
+    leaves a corrupt checkpoint behind.
+
+    """
+    n_corners = calibrator.cb_shape[0] * calibrator.cb_shape[1]
+    duration = scan['duration']
+    arrays = {
+        'version': np.asarray(CHECKPOINT_VERSION),
+        'video': np.asarray(scan['video']),
+        'cb_shape': np.asarray(calibrator.cb_shape, dtype=np.int64),
+        'frame_shape': np.asarray(calibrator.frame_shape or (0, 0), dtype=np.int64),
+        'start': np.asarray(scan['start'], dtype=np.int64),
+        'duration': np.asarray(duration if duration is not None else -1, dtype=np.int64),
+        'skip': np.asarray(scan['skip'], dtype=np.int64),
+        'next_frame': np.asarray(next_frame, dtype=np.int64),
+        'complete': np.asarray(complete),
+        'used_frames': np.asarray(calibrator.used_frames, dtype=np.int64),
+        'board_params': np.asarray(calibrator.used_board_params,
+            dtype=np.float64).reshape(-1, 4),
+        'image_pts': np.asarray(calibrator.image_pts,
+            dtype=np.float32).reshape(-1, n_corners, 2),
+    }
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_filename, filename)
+
+def load_checkpoint(filename):
+    """Load a checkpoint written by :py:func:`save_checkpoint` and return it
+    as a dictionary.
+
+    """
+    with np.load(filename) as arrays:
+        version = int(arrays['version'])
+        if version != CHECKPOINT_VERSION:
+            raise ValueError('Unsupported checkpoint version {0} in {1}'.format(version, filename))
+
+        duration = int(arrays['duration'])
+        frame_shape = tuple(int(x) for x in arrays['frame_shape'])
+        return {
+            'video': str(arrays['video']),
+            'cb_shape': tuple(int(x) for x in arrays['cb_shape']),
+            'frame_shape': frame_shape if frame_shape != (0, 0) else None,
+            'start': int(arrays['start']),
+            'duration': duration if duration >= 0 else None,
+            'skip': int(arrays['skip']),
+            'next_frame': int(arrays['next_frame']),
+            'complete': bool(arrays['complete']),
+            'used_frames': arrays['used_frames'].tolist(),
+            'board_params': arrays['board_params'],
+            'image_pts': arrays['image_pts'],
+        }
+
+def restore_checkpoint(calibrator, checkpoint):
+    """Add the boards recorded in the loaded *checkpoint* to *calibrator*
+    without re-applying board selection.
+
+    """
+    if calibrator.frame_shape is None:
+        calibrator.frame_shape = checkpoint['frame_shape']
+    for frame_idx, board_params, corners in zip(checkpoint['used_frames'],
+            checkpoint['board_params'], checkpoint['image_pts']):
+        calibrator.add_board(corners, board_params, frame_idx)
+
+def tool(video, checkpoint, cb_shape, skip=None, start=None, duration=None,
+        threshold=None, prescreen=None):
+    # Defaults
+    skip = skip or 1
+    start = start or 0
+
+    # Record files by absolute path so that checkpoints of the same video made
+    # via different relative paths can be merged
+    if not video.startswith(('device:', 'raw:')):
+        video = os.path.abspath(video)
+    scan = { 'video': video, 'start': start, 'duration': duration, 'skip': skip }
+
+    try:
+        calibrator = Calibrator(cb_shape, threshold=threshold,
+                prescreen=prescreen, autostop=False)
+    except ValueError as e:
+        log.error(str(e))
+        return 1
+
+    # Resume from an existing checkpoint if there is one
+    next_frame = start
+    if os.path.exists(checkpoint):
+        try:
+            state = load_checkpoint(checkpoint)
+        except (IOError, KeyError, ValueError) as e:
+            log.error('Could not load checkpoint {0}: {1}'.format(checkpoint, e))
+            return 1
+
+        if (state['video'], state['cb_shape'], state['start'], state['duration'], state['skip']) != \
+                (video, tuple(cb_shape), start, duration, skip):
+            log.error('Checkpoint {0} was written by a different scan'.format(checkpoint))
+            return 1
+
+        if state['complete']:
+            log.info('Scan in {0} is already complete'.format(checkpoint))
+            return 0
+
+        restore_checkpoint(calibrator, state)
+        next_frame = state['next_frame']
+        log.info('Resuming scan from frame {0} with {1} board(s)'.format(
+            next_frame, len(calibrator.image_pts)))
+
+    log.debug('Processing every {0} frame(s) from {1}'.format(skip, next_frame))
+
+    vc = open_video(video)
+    remaining = start + duration - next_frame if duration is not None else None
+    last_saved = next_frame
+    for frame_idx, frame in read_frames(vc, start=next_frame,
+            duration=remaining, skip=skip, seek=True):
+        next_frame = frame_idx + 1
+        progress = calibrator.add_frame(frame, frame_idx)
+        if progress is not None:
+            log.info('Using board in frame {0}. Progress: {1}'.format(frame_idx, progress))
+
+        if progress is not None or frame_idx - last_saved >= CHECKPOINT_INTERVAL:
+            save_checkpoint(checkpoint, calibrator, scan, next_frame)
+            last_saved = frame_idx
+
+    save_checkpoint(checkpoint, calibrator, scan, next_frame, complete=True)
+    log.info('Scan complete with {0} board(s)'.format(len(calibrator.image_pts)))
+
+    return 0
@@ -0,0 +1,238 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from calibtools.binary import BINARY_EXTENSION
+from calibtools.calib import load_calibration
+from calibtools.undistort import Undistorter
+
+log = logging.getLogger(__name__)
+
+class _CacheEntry(object):
+    def __init__(self):
+        self.future = concurrent.futures.Future()
+        self.refs = 0
+        self.last_used = time.monotonic()
+
+class MapCache(object):
+    """A thread-safe least recently used cache of :py:class:`Undistorter`
+    objects keyed by calibration id. *loader* is a callable which takes a
+    calibration id and returns a new undistorter for it.
+
+    Undistorters are obtained with :py:meth:`acquire` and must be handed back
+    with :py:meth:`release` when no longer needed. Only undistorters which are
+    not in use may be evicted, so at most *max_size* undistorters, and hence
+    sets of remap tables, are held at once unless more than that are in use.
+
+    """
+    def __init__(self, loader, max_size=8):
+        self.loader = loader
+        self.max_size = max(1, max_size)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, calib_id):
+        """Return the undistorter for *calib_id*, loading it if necessary.
+        Concurrent requests for the same id share a single load.
+
+        """
+        with self._lock:
+            entry = self._entries.get(calib_id)
+            loading = entry is None
+            if loading:
+                entry = self._entries[calib_id] = _CacheEntry()
+            else:
+                # Mark as most recently used
+                self._entries.move_to_end(calib_id)
+            entry.refs += 1
+            entry.last_used = time.monotonic()
+            if loading:
+                self._evict()
+
+        # Load outside of the lock so that other calibrations are not held up
+        if loading:
+            log.info('Computing undistort maps for calibration "{0}"'.format(calib_id))
+            try:
+                entry.future.set_result(self.loader(calib_id))
+            except Exception as e:
+                entry.future.set_exception(e)
+
+        try:
+            return entry.future.result()
+        except Exception:
+            with self._lock:
+                entry.refs -= 1
+                if self._entries.get(calib_id) is entry:
+                    del self._entries[calib_id]
+            raise
+
+    def release(self, calib_id):
+        """Hand back an undistorter obtained from :py:meth:`acquire`."""
+        with self._lock:
+            entry = self._entries[calib_id]
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            self._evict()
+
+    def _evict(self):
+        # Drop the least recently used unreferenced undistorters until we are
+        # within our size. Must be called with the lock held.
+        for calib_id in list(self._entries.keys()):
+            if len(self._entries) <= self.max_size:
+                break
+            if self._entries[calib_id].refs == 0:
+                log.info('Evicting undistort maps for calibration "{0}"'.format(calib_id))
+                del self._entries[calib_id]
+
+    def evict_idle(self, timeout):
+        """Discard undistorters which have not been in use for the last
+        *timeout* seconds.
+
+        """
+        cutoff = time.monotonic() - timeout
+        with self._lock:
+            for calib_id in list(self._entries.keys()):
+                entry = self._entries[calib_id]
+                if entry.refs == 0 and entry.last_used < cutoff:
+                    log.info('Evicting undistort maps for idle calibration "{0}"'.format(calib_id))
+                    del self._entries[calib_id]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+def directory_loader(directory):
+    """Return a loader for :py:class:`MapCache` which creates undistorters
+    from calibration files named *id*.ctb or *id*.json in *directory*.
+
+    """
+    def loader(calib_id):
+        if calib_id != os.path.basename(calib_id) or calib_id.startswith('.'):
+            raise ValueError('Invalid calibration id: "{0}"'.format(calib_id))
+        filename = os.path.join(directory, calib_id + BINARY_EXTENSION)
+        if not os.path.exists(filename):
+            filename = os.path.join(directory, calib_id + '.json')
+        return Undistorter.from_calibration(load_calibration(filename))
+    return loader
+
+class UndistortServer(object):
+    """Undistort raw RGB24 frame streams from many cameras sharing one
+    :py:class:`MapCache` *cache* and a pool of *workers* threads.
+
+    Each client connection starts with a header line of the form "ID WxH"
+    giving the calibration id and frame size of the stream. The server
+    replies with "OK" or "ERROR message" on a line of its own. After a
+    successful reply, each raw frame sent by the client is answered with the
+    corresponding undistorted raw frame.
+
+    """
+    def __init__(self, cache, workers=None):
+        self.cache = cache
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    async def handle_stream(self, reader, writer):
+        """Serve a single client connection."""
+        loop = asyncio.get_running_loop()
+        try:
+            header = (await reader.readline()).decode('utf8', 'replace').strip()
+            try:
+                calib_id, size = header.split()
+                w, h = tuple(int(x) for x in size.split('x'))
+            except ValueError:
+                raise ValueError('Could not parse stream header: "{0}"'.format(header))
+
+            undistorter = await loop.run_in_executor(self.executor, self.cache.acquire, calib_id)
+            if undistorter.frame_size != (w, h):
+                self.cache.release(calib_id)
+                raise ValueError('Stream size {0}x{1} does not match calibration size {2}x{3}'.format(
+                    w, h, *undistorter.frame_size))
+        except Exception as e:
+            log.error(str(e))
+            writer.write('ERROR {0}\n'.format(e).encode('utf8'))
+            await writer.drain()
+            writer.close()
+            return
+
+        log.info('Starting {0}x{1} stream with calibration "{2}"'.format(w, h, calib_id))
+        writer.write(b'OK\n')
+
+        nbytes = 3 * w * h
+        n_frames = 0
+        try:
+            while True:
+                try:
+                    data = await reader.readexactly(nbytes)
+                except asyncio.IncompleteReadError:
+                    break
+
+                frame = np.frombuffer(data, dtype=np.uint8).reshape(h, w, 3)
+                output = await loop.run_in_executor(self.executor,
+                        lambda: undistorter.undistort(frame).tobytes())
+
+                # Waiting for the client to consume output bounds our buffering
+                writer.write(output)
+                await writer.drain()
+                n_frames += 1
+        except (ConnectionError, BrokenPipeError) as e:
+            log.warning('Stream with calibration "{0}" failed: {1}'.format(calib_id, e))
+        except Exception as e:
+            log.error('Error undistorting stream with calibration "{0}": {1}'.format(calib_id, e))
+        finally:
+            self.cache.release(calib_id)
+            log.info('Finished stream with calibration "{0}" after {1} frame(s)'.format(
+                calib_id, n_frames))
+            writer.close()
+
+    async def evict_periodically(self, timeout):
+        """Evict undistorters which have been idle for *timeout* seconds."""
+        while True:
+            await asyncio.sleep(max(1, 0.5 * timeout))
+            self.cache.evict_idle(timeout)
+
+    async def serve(self, path, idle=None):
+        """Listen for connections on the local socket at *path* forever."""
+        server = await asyncio.start_unix_server(self.handle_stream, path=path)
+        log.info('Listening on {0}'.format(path))
+
+        evictor = None
+        if idle is not None:
+            evictor = asyncio.ensure_future(self.evict_periodically(idle))
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if evictor is not None:
+                evictor.cancel()
+            self.executor.shutdown(wait=False)
+
+def tool(calibrations, socket=None, workers=None, cache_size=None, idle=None):
+    socket = socket or 'calibtools.sock'
+    cache_size = cache_size if cache_size is not None else 8
+
+    if not os.path.isdir(calibrations):
+        log.error('Calibration directory "{0}" does not exist'.format(calibrations))
+        return 1
+
+    if os.path.exists(socket):
+        log.error('Socket "{0}" already exists'.format(socket))
+        return 1
+
+    cache = MapCache(directory_loader(calibrations), max_size=cache_size)
+    server = UndistortServer(cache, workers=workers)
+
+    try:
+        asyncio.run(server.serve(socket, idle=idle))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(socket):
+            os.unlink(socket)
+
+    return 0
@@ -3,9 +3,18 @@ Usage:
     calibtools (-h | --help) | --version
     calibtools calib [-v... | --verbose...] [--start=INDEX] [--duration=NUMBER]
         [--skip=NUMBER] [--shape=WxH] [--threshold=NUMBER]
-        [--no-stop] <video> [<output>]
+        [--prescreen=SCALE] [--drop-outliers=FACTOR] [--no-stop]
+        <video> [<output>]
+    calibtools scan [-v... | --verbose...] [--start=INDEX] [--duration=NUMBER]
+        [--skip=NUMBER] [--shape=WxH] [--threshold=NUMBER]
+        [--prescreen=SCALE] <video> <checkpoint>
+    calibtools merge [-v... | --verbose...] [--threshold=NUMBER]
+        [--drop-outliers=FACTOR] [--output=FILE] [--force] <checkpoints>...
     calibtools undistort [-v... | --verbose...] [--start=INDEX]
         [--duration=NUMBER] <calibration> <video> <output>
+    calibtools convert [-v... | --verbose...] <input> <output>
+    calibtools serve [-v... | --verbose...] [--socket=PATH] [--workers=NUMBER]
+        [--cache-size=NUMBER] [--idle=SECONDS] <calibrations>
 
 Common options:
     -h --help               Show a command line usage summary.
@@ -30,18 +39,91 @@ Calibration options:
                             what we have previously seen. A value of 0 will
                             include all boards and a value of 1 will *ignore*
                             all boards save the first one. [default: 0.2]
+    --prescreen=SCALE       Before full detection, look for the board in a
+                            copy of the frame downscaled by SCALE. Boards which
+                            are clearly not different enough to pass the
+                            threshold are then skipped without a full
+                            resolution detection. SCALE must be greater than 0
+                            and at most 1. A value of 1 disables pre-screening.
+                            [default: 0.5]
+    --drop-outliers=FACTOR  After calibrating, drop views whose re-projection
+                            error is more than FACTOR times the median view
+                            error and calibrate again without them. FACTOR
+                            must be at least 1.
     --no-stop               Don't automatically stop processing when enough
                             variation in board shape has been observed.
     <output>                Write calibration output in JSON format to <output>.
+                            The default behaviour is to write to standard
+                            output. The output includes the re-projection
+                            error of each view and of each corner within each
+                            view and a heatmap of mean error over an 8x8 grid
+                            covering the frame.
+
+Scan and merge options:
+    The scan and merge subcommands split calibration into independent chunks.
+    Each scan processes the frames selected by --start and --duration and
+    records the boards it finds in a checkpoint file. A scan does not stop
+    when enough variation in board shape has been observed. If a scan is
+    interrupted, re-running it with the same options resumes from the
+    checkpoint. The merge subcommand selects boards from all checkpoints,
+    which must all come from the same video, and calibrates using them. The
+    calibration options above have the same meaning for scan and merge.
+
+    Checkpoints record the absolute path of their video. Checkpoints whose
+    videos have the same file name but different directories, for example
+    when scanned on machines which mount the video at different paths, are
+    merged with a warning.
+
+    <checkpoint>            Record boards found by the scan in <checkpoint>.
+    <checkpoints>           Checkpoint files written by calibtools scan.
+    --output=FILE           Write calibration output in JSON format to FILE.
                             The default behaviour is to write to standard
                             output.
+    --force                 Merge checkpoints even if their videos have
+                            different file names.
 
 Undistort options:
-    <calibration>           A file containing calibration information in JSON
-                            format as output by calibtools calib.
+    <calibration>           A file containing calibration information as output
+                            by calibtools calib.
     <output>                Write raw RGB24 formatted output frames to <output>.
                             Use - to explicitly specify standard output.
 
+Calibration file formats:
+    Calibrations are written in JSON format unless the output file name ends
+    in .ctb, in which case a compact binary format is used. The binary format
+    additionally records the corners and pose of each view used for
+    calibration. Wherever a calibration file is read, either format may be
+    used.
+
+Convert options:
+    <input>                 Read a calibration in either format from <input>.
+    <output>                Write the calibration to <output>. The format is
+                            chosen by file name as above. Use - to write JSON
+                            to standard output.
+
+Serve options:
+    --socket=PATH           Listen for streams on the local socket PATH.
+                            [default: calibtools.sock]
+    --workers=NUMBER        Undistort frames using NUMBER worker threads shared
+                            by all streams. The default is based on the number
+                            of CPUs.
+    --cache-size=NUMBER     Keep undistort maps for at most NUMBER calibrations
+                            in memory. Maps used by open streams are never
+                            discarded, so more may be held if more than NUMBER
+                            calibrations are in use. [default: 8]
+    --idle=SECONDS          Discard undistort maps for calibrations which have
+                            had no open streams for SECONDS. [default: 300]
+    <calibrations>          A directory of calibration files. A stream using
+                            calibration id ID is undistorted with
+                            <calibrations>/ID.ctb if it exists or
+                            <calibrations>/ID.json otherwise.
+
+    Each connection to the socket should start with a line of the form
+    "ID WxH" giving the calibration id and the size of the stream's frames.
+    The server replies with "OK" or "ERROR message" on a line of its own.
+    After "OK", raw RGB24 frames may be written to the socket and the
+    corresponding undistorted frames will be written back.
+
 Specifying video input:
     When specifying video input (e.g. via <video>) one can use the filename of
     any file in format which OpenCV can understand. If one uses the form
@@ -86,27 +168,92 @@ def parse(v, type_, description=None, default=None):
 def calib(opts):
     from calibtools.calib import tool
 
+    try:
+        cb_shape = parse_shape(opts)
+        kwargs = {
+            'start':        parse(opts['--start'], int, 'starting index'),
+            'duration':     parse(opts['--duration'], int, 'duration'),
+            'skip':         parse(opts['--skip'], int, 'frame skip'),
+            'threshold':    parse(opts['--threshold'], float, 'threshold'),
+            'prescreen':    parse_prescreen(opts),
+            'outlier_factor': parse_outlier_factor(opts),
+            'output':       opts['<output>'],
+        }
+        video = opts['<video>']
+        autostop = not parse(opts['--no-stop'], bool, 'no stop flag')
+    except ValueError:
+        return 1
+
+    return tool(video, cb_shape, autostop=autostop, **kwargs)
+
+def parse_prescreen(opts):
+    scale = parse(opts['--prescreen'], float, 'pre-screen scale')
+    if scale is not None and not 0 < scale <= 1:
+        log.error('Pre-screen scale must be greater than 0 and at most 1: "{0}"'.format(
+            opts['--prescreen']))
+        raise ValueError('Pre-screen scale must be greater than 0 and at most 1')
+    return scale
+
+def parse_outlier_factor(opts):
+    factor = parse(opts['--drop-outliers'], float, 'outlier factor')
+    if factor is not None and not factor >= 1:
+        log.error('Outlier factor must be at least 1: "{0}"'.format(opts['--drop-outliers']))
+        raise ValueError('Outlier factor must be at least 1')
+    return factor
+
+def parse_positive(opts, option, type_, description):
+    value = parse(opts[option], type_, description)
+    if value is not None and not value > 0:
+        log.error('{0} must be greater than 0: "{1}"'.format(
+            description[0].upper() + description[1:], opts[option]))
+        raise ValueError('{0} must be greater than 0'.format(option))
+    return value
+
+def parse_shape(opts):
     try:
         cb_shape = tuple(int(x) for x in opts['--shape'].split('x'))
         assert len(cb_shape) == 2
     except (ValueError, AssertionError):
         log.error('Could not parse checkerboard size: "{0}"'.format(opts['--shape']))
-        return 1
+        raise ValueError('Could not parse checkerboard size')
+    return cb_shape
+
+@subcommand
+def scan(opts):
+    from calibtools.scan import tool
 
     try:
+        cb_shape = parse_shape(opts)
         kwargs = {
             'start':        parse(opts['--start'], int, 'starting index'),
             'duration':     parse(opts['--duration'], int, 'duration'),
             'skip':         parse(opts['--skip'], int, 'frame skip'),
             'threshold':    parse(opts['--threshold'], float, 'threshold'),
-            'output':       opts['<output>'],
+            'prescreen':    parse_prescreen(opts),
         }
         video = opts['<video>']
-        autostop = not parse(opts['--no-stop'], bool, 'no stop flag')
+        checkpoint = opts['<checkpoint>']
     except ValueError:
         return 1
 
-    return tool(video, cb_shape, autostop=autostop, **kwargs)
+    return tool(video, checkpoint, cb_shape, **kwargs)
+
+@subcommand
+def merge(opts):
+    from calibtools.merge import tool
+
+    try:
+        kwargs = {
+            'threshold':    parse(opts['--threshold'], float, 'threshold'),
+            'outlier_factor': parse_outlier_factor(opts),
+            'output':       opts['--output'],
+            'force':        opts['--force'],
+        }
+        checkpoints = opts['<checkpoints>']
+    except ValueError:
+        return 1
+
+    return tool(checkpoints, **kwargs)
 
 @subcommand
 def undistort(opts):
@@ -125,6 +272,28 @@ def undistort(opts):
 
     return tool(calibration, video, output, **kwargs)
 
+@subcommand
+def convert(opts):
+    from calibtools.binary import tool
+    return tool(opts['<input>'], opts['<output>'])
+
+@subcommand
+def serve(opts):
+    from calibtools.serve import tool
+
+    try:
+        kwargs = {
+            'socket':       opts['--socket'],
+            'workers':      parse_positive(opts, '--workers', int, 'number of workers'),
+            'cache_size':   parse_positive(opts, '--cache-size', int, 'cache size'),
+            'idle':         parse_positive(opts, '--idle', float, 'idle timeout'),
+        }
+        calibrations = opts['<calibrations>']
+    except ValueError:
+        return 1
+
+    return tool(calibrations, **kwargs)
+
 def main():
     # Parse command line options
     opts = docopt.docopt(__doc__, version=__version__)
@@ -1,5 +1,4 @@
-import itertools
-import json
+import asyncio
 import logging
 import sys
 
@@ -7,52 +6,84 @@ import cv2
 from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 import numpy as np
 
-from calibtools.util import open_video
+from calibtools.calib import load_calibration
+from calibtools.util import open_video, read_frames
 
 log = logging.getLogger(__name__)
 
+class Undistorter(object):
+    """Undistort frames from a camera with camera matrix *cam_matrix*,
+    distortion coefficients *dist_coeffs* and frame size *frame_size* given as
+    a width, height pair. The undistortion maps are computed once on
+    construction.
+
+    """
+    def __init__(self, cam_matrix, dist_coeffs, frame_size):
+        cam_matrix = np.asarray(cam_matrix, dtype=np.float64)
+        dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64)
+        self.frame_size = tuple(int(x) for x in frame_size)
+
+        # Compute optimal new matrix, etc
+        self.new_cam_matrix, self.valid_roi = cv2.getOptimalNewCameraMatrix(
+                cam_matrix, dist_coeffs, self.frame_size, 1)
+
+        # Calculate undistort maps
+        self.map1, self.map2 = cv2.initUndistortRectifyMap(
+                cam_matrix, dist_coeffs, None, self.new_cam_matrix,
+                self.frame_size, cv2.CV_16SC2)
+
+    @classmethod
+    def from_calibration(cls, calibration):
+        """Construct an undistorter from a
+        :py:class:`calibtools.calib.CalibrationResult`.
+
+        """
+        return cls(calibration.cam_matrix, calibration.dist_coeffs,
+                calibration.frame_size)
+
+    def undistort(self, frame):
+        """Return an undistorted copy of *frame*."""
+        return cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR)
+
+    def undistort_frames(self, frames):
+        """Lazily undistort each frame from the iterable *frames*."""
+        for frame in frames:
+            yield self.undistort(frame)
+
+    async def undistort_frames_async(self, frames, executor=None):
+        """Undistort each frame from the asynchronous iterable *frames*, e.g.
+        a :py:class:`calibtools.util.AsyncFrameSource`. The remapping is
+        performed in *executor* so that the event loop is not blocked.
+
+        """
+        loop = asyncio.get_running_loop()
+        async for frame in frames:
+            yield await loop.run_in_executor(executor, self.undistort, frame)
+
+def write_raw_frame(stream, frame):
+    """Write *frame* to the binary file-like object *stream* as raw RGB24."""
+    # We need to do color space conversion due to OpenCV's ordering
+    stream.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR).tobytes())
+
 def tool(calibration, video, output, start=None, duration=None):
     start = start or 0
 
     # Load calibration
     log.info('Loading calibration from {0}...'.format(calibration))
-    calibration = json.load(open(calibration))
-    cam_matrix = np.asarray(calibration['output']['camMatrix'])
-    dist_coeffs = np.asarray(calibration['output']['distCoeffs'])
-    frame_size = tuple(calibration['output']['frameSize'])
-
-    # Compute optimal new matrix, etc
-    new_cam_matrix, valid_roi = cv2.getOptimalNewCameraMatrix(
-            cam_matrix, dist_coeffs, frame_size, 1)
-
-    # Calculate undistort maps
-    map1, map2 = cv2.initUndistortRectifyMap(
-            cam_matrix, dist_coeffs, None, new_cam_matrix, frame_size,
-            cv2.CV_16SC2)
+    undistorter = Undistorter.from_calibration(load_calibration(calibration))
 
     # Load input video
     vc = open_video(video)
 
+    def frames():
+        for frame_idx, frame in read_frames(vc, start=start, duration=duration):
+            log.debug('Processing frame {0}...'.format(frame_idx))
+            yield frame
+
     # Prepare output
     vo = open(output, 'wb') if output != '-' else sys.stdout.buffer
-    for frame_idx in itertools.count(0):
-        flag, frame = vc.read()
-        if not flag:
-            break
-
-        # Skip frame if we're not processing this one
-        if frame_idx < start:
-            continue
-        if duration is not None and frame_idx >= start + duration:
-            break
-
-        log.debug('Processing frame {0}...'.format(frame_idx))
-
-        # Undistort
-        output = cv2.remap(frame, map1, map2, cv2.INTER_LINEAR)
-
-        # We need to do color space conversion due to OpenCV's ordering
-        vo.write(cv2.cvtColor(output, cv2.COLOR_RGB2BGR).tostring())
+    for frame in undistorter.undistort_frames(frames()):
+        write_raw_frame(vo, frame)
 
     vo.close()
 
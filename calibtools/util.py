@@ -1,5 +1,8 @@
+import asyncio
+import itertools
 import logging
 import sys
+import threading
 
 import cv2
 import numpy as np
@@ -50,3 +53,212 @@ def open_video(specifier):
         vc = cv2.VideoCapture(specifier)
 
     return vc
+
+def seek_video(vc, frame_idx):
+    """Attempt to seek the VideoCapture-like object *vc* so that the next
+    frame read is *frame_idx*. Return the index of the next frame which will
+    be read, which is 0 if seeking is not supported.
+
+    """
+    if frame_idx <= 0 or not hasattr(vc, 'set'):
+        return 0
+    if not vc.set(cv2.CAP_PROP_POS_FRAMES, frame_idx):
+        return 0
+    if int(vc.get(cv2.CAP_PROP_POS_FRAMES)) != frame_idx:
+        # Seeking went somewhere unexpected, start again from the beginning
+        vc.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return 0
+    log.debug('Seeked to frame {0}'.format(frame_idx))
+    return frame_idx
+
+def read_frames(vc, start=None, duration=None, skip=None, seek=False):
+    """Generate (index, frame) pairs read from the VideoCapture-like object
+    *vc*. Frames before *start* are discarded, at most *duration* frames from
+    *start* are considered and only every *skip*-th frame is returned. If
+    *seek* is True, an attempt is made to seek directly to *start* rather than
+    reading and discarding the preceding frames.
+
+    """
+    start = start or 0
+    skip = skip or 1
+
+    first_idx = seek_video(vc, start) if seek else 0
+
+    for frame_idx in itertools.count(first_idx):
+        # Stop processing after specified duration
+        if duration is not None and frame_idx >= start + duration:
+            break
+
+        flag, frame = vc.read()
+        if not flag:
+            break
+
+        # Skip frame if we're not processing this one
+        if frame_idx < start or frame_idx % skip != 0:
+            continue
+
+        yield frame_idx, frame
+
+# Marker placed on queues by the asynchronous adapters to signal end of stream
+_END = object()
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+class AsyncFrameSource(object):
+    """Asynchronous iterator over the items of the blocking iterable *frames*,
+    e.g. as returned by :py:func:`read_frames`. Items are read in *executor*
+    (the event loop's default executor if None) and at most *prefetch* items
+    are buffered ahead of the consumer.
+
+    A source should be used as an asynchronous context manager, or have
+    :py:meth:`aclose` called, so that reading stops if the consumer finishes
+    early.
+
+    """
+    def __init__(self, frames, prefetch=4, executor=None):
+        self.frames = iter(frames)
+        self.executor = executor
+        self._queue = asyncio.Queue(maxsize=max(1, prefetch))
+        self._task = None
+        self._closed = False
+
+        # Serialises access to the iterator between reads and closing, which
+        # may happen in different executor threads
+        self._lock = threading.Lock()
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._read())
+
+        item = await self._queue.get()
+        if item is _END:
+            # Leave the marker for any subsequent calls
+            self._queue.put_nowait(_END)
+            raise StopAsyncIteration
+        if isinstance(item, _Failure):
+            self._queue.put_nowait(_END)
+            raise item.exc
+        return item
+
+    def _next(self):
+        with self._lock:
+            return next(self.frames, _END)
+
+    def _close_frames(self):
+        with self._lock:
+            close = getattr(self.frames, 'close', None)
+            if close is not None:
+                close()
+
+    async def _read(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                item = await loop.run_in_executor(self.executor, self._next)
+                await self._queue.put(item)
+                if item is _END:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._queue.put(_Failure(e))
+
+    async def aclose(self):
+        """Stop reading frames and close the underlying iterator, e.g. to
+        release the generator returned by :py:func:`read_frames` and its
+        capture. Any buffered frames are discarded.
+
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # Drop buffered frames
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+        # Waits for any read still running in the executor to finish
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._close_frames)
+        self.frames = iter(())
+
+def async_read_frames(vc, start=None, duration=None, skip=None, prefetch=4,
+        executor=None):
+    """Return an :py:class:`AsyncFrameSource` generating the (index, frame)
+    pairs which :py:func:`read_frames` would for the same arguments.
+
+    """
+    return AsyncFrameSource(read_frames(vc, start=start, duration=duration, skip=skip),
+            prefetch=prefetch, executor=executor)
+
+class AsyncFrameSink(object):
+    """Asynchronous sink which passes each frame to the blocking callable
+    *write* in *executor* (the event loop's default executor if None). At most
+    *maxsize* frames are queued; :py:meth:`write` waits when the queue is full
+    so that producers are slowed to the rate of the underlying output.
+
+    """
+    def __init__(self, write, maxsize=4, executor=None):
+        self._write = write
+        self.executor = executor
+        self._queue = asyncio.Queue(maxsize=max(1, maxsize))
+        self._task = None
+        self._exc = None
+
+    async def write(self, frame):
+        """Queue *frame* for writing, waiting if the queue is full. Raises
+        any exception raised by a previous write.
+
+        """
+        if self._exc is not None:
+            raise self._exc
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._drain())
+        await self._queue.put(frame)
+
+    async def close(self):
+        """Wait for all queued frames to be written. Raises any exception
+        raised while writing.
+
+        """
+        if self._task is not None:
+            await self._queue.put(_END)
+            await self._task
+            self._task = None
+        if self._exc is not None:
+            raise self._exc
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            frame = await self._queue.get()
+            if frame is _END:
+                break
+            if self._exc is not None:
+                # Discard frames after a failure but keep draining so that
+                # writers are not blocked forever
+                continue
+            try:
+                await loop.run_in_executor(self.executor, self._write, frame)
+            except Exception as e:
+                self._exc = e